@@ -1,128 +1,194 @@
-import random
+import argparse
+import collections
+import itertools
+import multiprocessing
 import neat
+import numpy as np
 import os
-import time
-import visualize
+import warnings
+
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """ Numba isn't installed: leave the game functions as plain Python """
+        if args and callable(args[0]):
+            return args[0]
+        return lambda function: function
+
+# Ball colors, as held in the field's goal slots
+EMPTY = 0
+RED = 1
+BLUE = 2
+COLORS = (RED, BLUE)
+SYMBOLS = '.RB'
+
+# The first NN input represents the color the player is playing, 1.0 for Red, and -1.0 for Blue
+COLOR_INPUTS = (0.0, 1.0, -1.0)
+
+# The NN descriptor of a goal is a unique three digit number nnn, where each n represents the
+# top, middle and bottom slot respectively and is 2 for Red, 1 for Blue, and 0 for empty. For
+# example a goal in state Red/Red/Blue is 221. Each goal state is coded as a 6 bit number (2 bits
+# per slot, bottom first), and the descriptors for all the codes are worked out once here.
+DESCRIPTOR_DIGITS = (0, 2, 1, 0)
+DESCRIPTOR_LUT = np.array([(DESCRIPTOR_DIGITS[code & 3] +
+                            DESCRIPTOR_DIGITS[(code >> 2) & 3] * 10 +
+                            DESCRIPTOR_DIGITS[(code >> 4) & 3] * 100) / 1000.0
+                           for code in range(64)], np.float32)
+
+# Networks are matched up for the game cache on their weights, biases and responses rounded
+# to this many decimal places; the cache keeps the results of this many games
+SIGNATURE_DIGITS = 4
+GAME_CACHE_SIZE = 100000
+
+# Number of goals a random player draws from the random number generator at a time
+RANDOM_GOALS = 1000
+
+# Number of games played as each color against the random player by eval_single_genome
+REFERENCE_GAMES = 10
+
+# One random number generator per process, reseeded in forked worker processes so that they
+# don't all play the same random games
+rng = np.random.default_rng()
+
+def _reseed_rng():
+    """ Give a forked worker process its own random number generator """
+    global rng
+    rng = np.random.default_rng()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reseed_rng)
+
+# Results of the games between networks, keyed on the (red, blue) network signatures and
+# least recently used first
+_game_cache = collections.OrderedDict()
+
+# The rows of three goals that score bonus points when owned by one color
+ROWS = np.array([[0,1,2], [3,4,5], [6,7,8], [0,3,6], [1,4,7], [2,5,8], [0,4,8], [2,4,6]], np.intp)
+
+# The owners of the goals are packed into one word, 2 bits per goal (goal k in bits 2k and
+# 2k+1), so a row is owned by a color when the row's bits match that color's pattern
+GOAL_MASKS = np.array([3 << 2*goal for goal in range(9)], np.uint32)
+ROW_MASKS = np.array([sum(3 << 2*goal for goal in row) for row in ROWS.tolist()], np.uint32)
+RED_ROWS = np.array([sum(RED << 2*goal for goal in row) for row in ROWS.tolist()], np.uint32)
+BLUE_ROWS = np.array([sum(BLUE << 2*goal for goal in row) for row in ROWS.tolist()], np.uint32)
+
+
+# The game itself is compiled with Numba: these work directly on a field's arrays, see Field
+
+@njit(cache=True)
+def score_goal(slots, heights, owners, balls, goal, color):
+    """ Score a <color> ball in the <goal>th goal """
+
+    # Can't add another ball to a goal that is full
+    height = heights[goal]
+    if height == 3:
+        return False
+
+    # Add the ball to the topmost empty slot
+    slots[goal, height] = color
+    heights[goal] += 1
+    owners[0] = (owners[0] & ~GOAL_MASKS[goal]) | np.uint32(color << 2*goal)
+    balls[color] += 1
+
+    return True
+
+@njit(cache=True)
+def de_score_goal(slots, heights, owners, balls, goal):
+    """ Remove a ball from the bottom of the <goal>th goal """
+
+    # Can't remove a ball from an empty goal
+    if heights[goal] == 0:
+        return False
+
+    # Slide the balls down one position
+    balls[slots[goal, 0]] -= 1
+    slots[goal, 0] = slots[goal, 1]
+    slots[goal, 1] = slots[goal, 2]
+    slots[goal, 2] = EMPTY
+    heights[goal] -= 1
+    if heights[goal] == 0:
+        owners[0] &= ~GOAL_MASKS[goal]
+
+    return True
+
+@njit(cache=True)
+def field_score(owners, balls):
+    """ get the score for the field, return a tuple (<red>, <blue>) """
+
+    # 1 point for each ball in goal
+    red = balls[RED]
+    blue = balls[BLUE]
+
+    # Six points for each row owned
+    for row in range(8):
+        row_owners = owners[0] & ROW_MASKS[row]
+        if row_owners == RED_ROWS[row]:
+            red += 6
+        elif row_owners == BLUE_ROWS[row]:
+            blue += 6
+
+    return red, blue
+
+@njit(cache=True)
+def play_random_game(slots, heights, owners, balls, goals):
+    """ Play a game of ChangeUp between two random players, red scoring in goals[0::2] and
+        blue in goals[1::2] """
 
-class Goal():
-    """ Represents the ChangeUp Goal """
-
-    def __init__(self):
-        """ Initialize: set the top, middle and the bottom of the goal to empty """
-        self.bottom = '.'
-        self.middle = '.'
-        self.top    = '.'
-
-    def score(self, color):
-        """ Add a <color> ball to the top of the goal """
-
-        # Can't add another ball to a goal that is full """
-        if self.top != '.':
-            return False
-
-        # Add the ball to the topmost empty slot """
-        if self.bottom == '.':
-            self.bottom = color
-        elif self.middle == '.':
-            self.middle = color
-        else:
-            self.top = color
-
-        return True
-
-    def de_score(self):
-        """ Remove a ball from the bottom of the goal """
-
-        # Can't remove a ball from an empty goal
-        if self.bottom == ',':
-            return False
-
-        # Slide the balls down one position
-        self.bottom = self.middle
-        self.middle = self.top
-        self.top = '-'
-
-        return True
-
-    def owned_by(self):
-        """ Who owns the goal? i.e. which color is the topmost ball? """
-        if self.top != '.':
-            return self.top
-        elif self.middle != '.':
-            return self.middle
-        else:
-            return self.bottom
-
-    def descriptor(self):
-        """ Return a number that describes the goal state for NN purposes """
-
-        # Generate a unique three digit integger nnn, where each n represents the top, middle,
-        # and bottom goal slot respectievly, and n is 2 for Red, 1 for Blue, and 0 for empty.
-        # For example a goal in state Red/Red/Blue will be encoded as 221.
-        descriptor = 0
-        if self.bottom == 'R': descriptor += 2
-        if self.bottom == 'B': descriptor += 1
-        if self.middle == 'R': descriptor += 20
-        if self.middle == 'B': descriptor += 10
-        if self.top    == 'R': descriptor += 200
-        if self.top    == 'B': descriptor += 100
-
-        # Convert to a smaller floating point number for the neural net and return
-        return float(descriptor/1000.0)
-
-
-    def get_score(self):
-        """ Get the score for the goal, return a tuple (<red>, <blue>) """
-        scores = [0, 0]
-
-        # One point for each blaa in goal
-        for index, color in enumerate(['R', 'B']):
-            if self.bottom == color: scores[index] += 1
-            if self.middle == color: scores[index] += 1
-            if self.top == color: scores[index] += 1
-
-        return (scores[0], scores[1])
+    # Place 10 balls each
+    for i in range(10):
+        score_goal(slots, heights, owners, balls, goals[2*i], RED)
+        score_goal(slots, heights, owners, balls, goals[2*i+1], BLUE)
 
 
 class Field():
-    """ Implements the field object """
+    """ Implements the field object
+
+        The 9 goals are stored as arrays rather than objects: slots[goal] holds the color of the
+        bottom, middle and top ball in the goal and heights[goal] the number of balls in it. The
+        owner of each goal and the number of balls of each color are kept up to date as balls
+        are scored and de-scored, packed into owners[0] (see GOAL_MASKS) and in balls[color] """
 
     def __init__(self):
-        """ Initialize: create the 9 goals on the field """
-        self.goals = []
-        for i in range(9):
-            self.goals.append(Goal())
+        """ Initialize: create the 9 empty goals on the field """
+        self.slots = np.zeros((9, 3), np.int8)
+        self.heights = np.zeros(9, np.int8)
+        self.owners = np.zeros(1, np.uint32)
+        self.balls = np.zeros(3, np.int16)
+
+    def reset(self):
+        """ Reset: empty all the goals, ready for another game """
+        self.slots.fill(EMPTY)
+        self.heights.fill(0)
+        self.owners.fill(0)
+        self.balls.fill(0)
 
     def score(self, goal, color):
-        """ Score a <coloe> ball in the <goal>th goal """
-        return self.goals[goal].score(color)
+        """ Score a <color> ball in the <goal>th goal """
+        return score_goal(self.slots, self.heights, self.owners, self.balls, goal, color)
 
-    def get_score(self):
-        """ get the score for the field, return a tuple (<red>, <blue>) """
-        scores = [0,0] # red, blue
+    def de_score(self, goal):
+        """ Remove a ball from the bottom of the <goal>th goal """
+        return de_score_goal(self.slots, self.heights, self.owners, self.balls, goal)
 
-        # 1 point for each blaa in goal
-        for goal in self.goals:
-            goal_score = goal.get_score()
-            scores[0] += goal_score[0]
-            scores[1] += goal_score[1]
+    def owned_by(self, goal):
+        """ Who owns the <goal>th goal? i.e. which color is the topmost ball? """
+        return (self.owners[0] >> 2*goal) & 3
 
-        # Six points for each row owned
-        rows = [(0,1,2), (3,4,5), (6,7,8), (0,3,6), (1,4,7), (2,5,8), (0,4,8), (2,4,6)]
-        for index, color in enumerate(['R', 'B']):
-            for row in rows:
-                if (self.goals[row[0]].owned_by() == color) and (self.goals[row[1]].owned_by() == color) and (self.goals[row[2]].owned_by() == color):
-                    scores[index] += 6
+    def get_score(self):
+        """ get the score for the field, return a tuple (<red>, <blue>) """
 
-        return (scores[0], scores[1])
+        # Return Python ints: without Numba the scores come back as the int16 ball counts,
+        # which would wrap around when the tournament adds them up
+        red, blue = field_score(self.owners, self.balls)
+        return int(red), int(blue)
 
     def print(self):
         """ Print the state of the field and the current score """
         print("+-----------------------+")
         for i in range(3):
-            print("|%s          %s          %s|" % (self.goals[i*3].top, self.goals[i*3+1].top, self.goals[i*3+2].top))
-            print("|%s          %s          %s|" % (self.goals[i*3].middle, self.goals[i*3+1].middle, self.goals[i*3+2].middle))
-            print("|%s          %s          %s|" % (self.goals[i*3].bottom, self.goals[i*3+1].bottom, self.goals[i*3+2].bottom))
+            for slot in (2, 1, 0):
+                print("|%s          %s          %s|" % tuple(SYMBOLS[color] for color in self.slots[i*3:i*3+3, slot]))
             if i < 2:
                 print("|                       |")
         print("+-----------------------+")
@@ -131,13 +197,78 @@ class Field():
         print("Red = %02d        Blue = %02d" % scores)
         print()
 
+    def get_codes(self):
+        """ Return an array of the 6 bit state codes for each of the goals """
+        return self.slots[:, 0] | (self.slots[:, 1] << 2) | (self.slots[:, 2] << 4)
+
     def get_descriptors(self):
-        """ Return a list of the descriptors for each of the goals """
-        descriptors = []
-        for i in range(9):
-            descriptors.append(self.goals[i].descriptor())
+        """ Return an array of the descriptors for each of the goals """
+        return DESCRIPTOR_LUT[self.get_codes()]
+
+
+# NumPy versions of the neat-python activation functions that BatchNetwork can compile
+NUMPY_ACTIVATIONS = {
+    neat.activations.tanh_activation: lambda z: np.tanh(np.clip(2.5 * z, -60.0, 60.0)),
+    neat.activations.sigmoid_activation: lambda z: 1.0 / (1.0 + np.exp(-np.clip(5.0 * z, -60.0, 60.0))),
+    neat.activations.relu_activation: lambda z: np.maximum(z, 0.0),
+    neat.activations.identity_activation: lambda z: z,
+}
+
+
+class BatchNetwork():
+    """ A NEAT FeedForwardNetwork compiled to NumPy, activated on a whole batch of inputs at once
+
+        The nodes are grouped into layers that only depend on earlier layers, and each layer is
+        evaluated with one matrix multiply over the values of all the nodes """
+
+    def __init__(self, net):
+        """ Initialize: build the weights, biases and responses for each layer of <net> """
+        self.net = net
 
-        return descriptors
+        # Every node gets a column in the values matrix, inputs first
+        nodes = net.input_nodes + [node_eval[0] for node_eval in net.node_evals]
+        nodes += [node for node in net.output_nodes if node not in nodes]
+        self.columns = {node: column for column, node in enumerate(nodes)}
+        self.outputs = [self.columns[node] for node in net.output_nodes]
+
+        # Anything other than summed inputs and a known activation function is left to the
+        # neat-python network
+        self.compiled = all(act_func in NUMPY_ACTIVATIONS and agg_func is neat.aggregations.sum_aggregation
+                            for node, act_func, agg_func, bias, response, links in net.node_evals)
+        if not self.compiled:
+            return
+
+        # Group the nodes by depth (and activation function): each group is one layer
+        depths = {}
+        groups = {}
+        for node_eval in net.node_evals:
+            node, act_func, agg_func, bias, response, links = node_eval
+            depths[node] = 1 + max((depths.get(i, 0) for i, w in links), default=0)
+            groups.setdefault((depths[node], act_func), []).append(node_eval)
+
+        self.layers = []
+        for (depth, act_func), node_evals in sorted(groups.items(), key=lambda group: group[0][0]):
+            weights = np.zeros((len(nodes), len(node_evals)))
+            for n, (node, _, _, bias, response, links) in enumerate(node_evals):
+                for i, w in links:
+                    weights[self.columns[i], n] += w
+            self.layers.append((np.array([self.columns[node_eval[0]] for node_eval in node_evals]),
+                                weights,
+                                np.array([node_eval[3] for node_eval in node_evals]),
+                                np.array([node_eval[4] for node_eval in node_evals]),
+                                NUMPY_ACTIVATIONS[act_func]))
+
+    def activate(self, inputs):
+        """ Activate the network on each row of <inputs>, return an array of the outputs """
+        if not self.compiled:
+            return np.array([self.net.activate(row) for row in inputs])
+
+        values = np.zeros((len(inputs), len(self.columns)))
+        values[:, :len(self.net.input_nodes)] = inputs
+        for nodes, weights, biases, responses, activation in self.layers:
+            values[:, nodes] = activation(biases + responses * (values @ weights))
+
+        return values[:, self.outputs]
 
 
 class Player():
@@ -147,58 +278,159 @@ class Player():
         """ Initialize: store the name and strategy for the player """
         self.name = name
         self.strategy = strategy
-
-    def add_net(self, net):
-        """ Add a NEAT network for this player """
-        self.net = net
+        self._nn_in = np.empty((1, 10), np.float32)
+        self._random_goals = []
+        self.signature = None
+
+    def add_genome(self, genome, config):
+        """ Add a NEAT genome for this player and build its network """
+        self.genome = genome
+        self.config = config
+        self.net = BatchNetwork(neat.nn.FeedForwardNetwork.create(genome, config))
+        self._move_cache = {}
+
+        # Players with the same signature play the same games
+        self.signature = hash(tuple((node, act_func, agg_func, round(bias, SIGNATURE_DIGITS), round(response, SIGNATURE_DIGITS),
+                                     tuple((i, round(w, SIGNATURE_DIGITS)) for i, w in links))
+                                    for node, act_func, agg_func, bias, response, links in self.net.net.node_evals))
+
+    def __getstate__(self):
+        """ Pickle the player for a worker process: the networks don't pickle reliably, so send
+            the genome and config instead and rebuild the network on the other side """
+        state = self.__dict__.copy()
+        state.pop('net', None)
+        state['_random_goals'] = []
+        return state
+
+    def __setstate__(self, state):
+        """ Unpickle the player, rebuilding its network from the genome """
+        self.__dict__.update(state)
+        if 'genome' in state:
+            self.net = BatchNetwork(neat.nn.FeedForwardNetwork.create(self.genome, self.config))
 
     def make_move(self, field, color):
         """ Make a move, player color <color>, depending on the player's strategy """
         if self.strategy == 'random':
             return self.random_choice(field, color)
         elif self.strategy == 'neat-ai':
-            return self.neat_choice(field, color)
+            return self.neat_choices([field], color)
+
+    def make_moves(self, fields, color):
+        """ Make a move on each of <fields>, player color <color> """
+        if self.strategy == 'neat-ai':
+            return self.neat_choices(fields, color)
+        for field in fields:
+            self.make_move(field, color)
 
     def random_choice(self, field, color):
         """ Really simple - simply add ball to random goal """
-        field.goals[random.randint(0,8)].score(color)
 
-    def neat_choice(self, field, color):
+        # Draw the random goals in bulk
+        if not self._random_goals:
+            self._random_goals = rng.integers(0, 9, RANDOM_GOALS).tolist()
+        field.score(self._random_goals.pop(), color)
+
+    def neat_choices(self, fields, color):
         """ NEAT neural network """
+        for field, max_output_idx in zip(fields, self.neat_moves(fields, color)):
 
-        # First input node represnts the color the player is playing, 1.0 for Red, and -1.0 for Blue
-        if color == 'R':
-            input_list = [1.0]
-        else:
-            input_list = [-1.0]
+            # Make the move: outputs 0-8 represent scoring a goal, outputs 9-17 represent de-scoring that goal
+            if max_output_idx < 9:
+                field.score(max_output_idx, color)
+            else:
+                field.de_score(max_output_idx-9)
+
+    def neat_moves(self, fields, color):
+        """ Choose the NEAT network's move on each of <fields>, return the indexes of the chosen outputs """
+
+        # The network's choice depends only on the color and the state of the goals, and the
+        # same positions come up again and again over a tournament, so remember each choice
+        keys = [(color, field.get_codes().tobytes()) for field in fields]
+        moves = [self._move_cache.get(key) for key in keys]
+
+        # Activate the network once for all the positions it hasn't seen before
+        new = [k for k, move in enumerate(moves) if move is None]
+        if new:
+            for k, max_output_idx in zip(new, self.neat_activate([fields[k] for k in new], color)):
+                moves[k] = self._move_cache[keys[k]] = max_output_idx
+
+        return moves
+
+    def neat_activate(self, fields, color):
+        """ Activate the NEAT network on each of <fields>, return a list of the indexes of the
+            chosen outputs """
+
+        # Fill in the inputs in a buffer kept on the player, grown as needed
+        if len(self._nn_in) < len(fields):
+            self._nn_in = np.empty((len(fields), 10), np.float32)
+        input_batch = self._nn_in[:len(fields)]
+
+        # First input node represnts the color the player is playing
+        input_batch[:, 0] = COLOR_INPUTS[color]
 
         # Add the descrptions for each of the goals
-        descriptors = field.get_descriptors()
-        for descriptor in descriptors:
-            input_list.append(descriptor)
+        input_batch[:, 1:] = DESCRIPTOR_LUT[np.array([field.get_codes() for field in fields])]
 
         # Activate the nextwork
-        output = self.net.activate(tuple(input_list))
-
-        # Make the move: outputs 0-8 represent scoring a goal, outputs 9-17 represent de-scoring that goal
-        max_output_idx = output.index(max(output))
-        if max_output_idx < 9:
-            field.goals[max_output_idx].score(color)
-        else:
-            field.goals[max_output_idx-9].de_score()
+        return self.net.activate(input_batch).argmax(axis=1).tolist()
 
 
 def play_a_game(field, player1, player2, showmoves=False):
     """ Play a game of  ChangeUp """
 
-    # Place 10 balls each
-    for i in range(10):
-        player1.make_move(field, 'R')
-        player2.make_move(field, 'B')
+    # Place 10 balls each, entirely in compiled code if there's no network involved
+    if player1.strategy == 'random' and player2.strategy == 'random':
+        play_random_game(field.slots, field.heights, field.owners, field.balls, rng.integers(0, 9, 20))
+    else:
+        for i in range(10):
+            player1.make_move(field, RED)
+            player2.make_move(field, BLUE)
 
     if showmoves == True:
         field.print()
 
+def play_games(fields, matches, players):
+    """ Play the games of ChangeUp <matches> [(<red>, <blue>), ...] side by side on <fields>, so
+        that each player makes its moves in all of its games at once """
+
+    # Games between two random players are played entirely in compiled code, the rest are
+    # grouped by the player on each side
+    games = ({}, {})
+    for k, match in enumerate(matches):
+        if players[match[0]].strategy == 'random' and players[match[1]].strategy == 'random':
+            play_random_game(fields[k].slots, fields[k].heights, fields[k].owners, fields[k].balls,
+                             rng.integers(0, 9, 20))
+            continue
+        for side in (0, 1):
+            games[side].setdefault(match[side], []).append(fields[k])
+
+    # Place 10 balls each
+    for i in range(10):
+        for side, color in enumerate(COLORS):
+            for player, player_fields in games[side].items():
+                players[player].make_moves(player_fields, color)
+
+def _init_worker(players):
+    """ Give each tournament worker process its own copy of the players, and somewhere to
+        keep the fields it plays on """
+    global _players, _fields
+    _players = players
+    _fields = []
+
+def _play_matches(matches):
+    """ Play a chunk of tournament matches [(<i>, <j>), ...] in a worker,
+        return [(<i>, <j>, <red>, <blue>), ...] """
+
+    # Reuse the worker's fields from chunk to chunk
+    while len(_fields) < len(matches):
+        _fields.append(Field())
+    fields = _fields[:len(matches)]
+    for field in fields:
+        field.reset()
+
+    play_games(fields, matches, _players)
+    return [match + field.get_score() for match, field in zip(matches, fields)]
+
 def play_a_tournament(players, rounds=1):
     """ Play a tornament: each play plays each other twice, once as red, once as blue """
 
@@ -207,24 +439,48 @@ def play_a_tournament(players, rounds=1):
     total_score = 0
     wins = [0]*len(players)
 
-    # Round robin...
-    for _ in range(rounds):
-        for i in range(len(players)):
-            for j in range(len(players)):
-                if i != j: # players don't play themselves
-                    field = Field()
-                    play_a_game(field, players[i], players[j])
-
-                    # Collect statistics
-                    score = field.get_score()
-                    if score[0] > score[1]:
-                        wins[i] += 1
-                    elif score[1] > score[0]:
-                        wins[j] += 1
-                    total_score += score[0] + score[1]
-                    if max(score) > high_score:
-                        high_score = max(score)
-                    #print("Game", i, j, players[i].name, score[0], "-", players[j].name, score[1])
+    # Round robin... players don't play themselves
+    pairs = [(i, j) for i in range(len(players))
+             for j in itertools.chain(range(i), range(i+1, len(players)))] * rounds
+
+    # Games between two networks always go the same way, so reuse the results from earlier
+    # generations where the same (or next to the same) networks met, and only play the rest
+    results = []
+    new_pairs = []
+    for i, j in pairs:
+        key = (players[i].signature, players[j].signature)
+        if key in _game_cache:
+            _game_cache.move_to_end(key)
+            results.append((i, j) + _game_cache[key])
+        else:
+            new_pairs.append((i, j))
+
+    # The games are independent, so share them out across all the cores in chunks that each
+    # worker plays side by side
+    if new_pairs:
+        workers = multiprocessing.cpu_count()
+        size = max(1, len(new_pairs)//(4*workers))
+        chunks = [new_pairs[k:k+size] for k in range(0, len(new_pairs), size)]
+        with multiprocessing.Pool(workers, _init_worker, (players,)) as pool:
+            for i, j, red, blue in itertools.chain.from_iterable(pool.imap_unordered(_play_matches, chunks)):
+                results.append((i, j, red, blue))
+                if players[i].signature is not None and players[j].signature is not None:
+                    _game_cache[(players[i].signature, players[j].signature)] = (red, blue)
+
+        while len(_game_cache) > GAME_CACHE_SIZE:
+            _game_cache.popitem(last=False)
+
+    for i, j, red, blue in results:
+
+        # Collect statistics
+        if red > blue:
+            wins[i] += 1
+        elif blue > red:
+            wins[j] += 1
+        total_score += red + blue
+        if max(red, blue) > high_score:
+            high_score = max(red, blue)
+        #print("Game", i, j, players[i].name, red, "-", players[j].name, blue)
 
     # Return the statistics
     return wins, high_score, total_score
@@ -234,18 +490,26 @@ def eval_genomes(genomes, config):
     """ Called by NEAT to evaluate the genome fitness """
 
     # Create the genome itself
-    nets = []
     players = []
     ge = []
     for genome_id, genome in genomes:
         genome.fitness = 0
-        net = neat.nn.FeedForwardNetwork.create(genome, config)
-        nets.append(net)
         player = Player("NEAT-%s" % genome_id, 'neat-ai')
-        player.add_net(net)
+        player.add_genome(genome, config)
         players.append(player)
         ge.append(genome)
 
+    # Every game starts on an empty field, so work out each player's opening move as Red, and
+    # its reply as Blue to each of the (few) different Red openings, once here. They go out to
+    # the tournament workers in the players' move caches.
+    openings = {}
+    for player in players:
+        field = Field()
+        player.make_move(field, RED)
+        openings[field.get_codes().tobytes()] = field
+    for player in players:
+        player.neat_moves(list(openings.values()), BLUE)
+
     # All the players play a tournament to see which are best
     wins, high_score, total_score = play_a_tournament(players)
 
@@ -259,8 +523,38 @@ def eval_genomes(genomes, config):
     print("Average score:", total_score/(len(wins)*99))
 
 
-def run(config_file):
-    """ Run the NEAT algorithm using the provided config file"""
+def eval_single_genome(genome, config):
+    """ Called by the NEAT ParallelEvaluator to evaluate one genome's fitness: its total score
+        margin over REFERENCE_GAMES games each as red and as blue against a random player.
+        Hardly any networks beat a random player early on, so counting wins would leave almost
+        every genome on 0 with nothing for NEAT to select on; the margin still ranks them. """
+    player = Player("NEAT-%s" % genome.key, 'neat-ai')
+    player.add_genome(genome, config)
+    opponent = Player('Random', 'random')
+
+    margin = 0
+    field = Field()
+    for _ in range(REFERENCE_GAMES):
+        field.reset()
+        play_a_game(field, player, opponent)
+        red, blue = field.get_score()
+        margin += red - blue
+
+        field.reset()
+        play_a_game(field, opponent, player)
+        red, blue = field.get_score()
+        margin += blue - red
+
+    return margin
+
+
+def run(config_file, evaluation='tournament', draw_net=False):
+    """ Run the NEAT algorithm using the provided config file
+
+        With evaluation 'tournament' the genomes' fitness is their wins in a round robin against
+        each other; with 'reference' each genome is evaluated on its own by its score margin
+        against a random player, one genome per worker process. With draw_net the winning
+        network is drawn with graphviz """
     config = neat.config.Config(neat.DefaultGenome, neat.DefaultReproduction,
                          neat.DefaultSpeciesSet, neat.DefaultStagnation,
                          config_file)
@@ -274,26 +568,38 @@ def run(config_file):
     p.add_reporter(stats)
     #P.Add_reporter(Neat.Checkpointer(5))
 
-    # Run For Up To 50 Generations.
-    winner = p.run(eval_genomes, 1000)
+    # Run For Up To 1000 Generations.
+    if evaluation == 'reference':
+        evaluator = neat.ParallelEvaluator(multiprocessing.cpu_count(), eval_single_genome)
+        winner = p.run(evaluator.evaluate, 1000)
+    else:
+        winner = p.run(eval_genomes, 1000)
 
     # Show Final Stats
     print('\nbest Genome:\n{!s}'.format(winner))
-    visualize.draw_net(config,winner, True)
+    if draw_net:
+        try:
+            import visualize
+            visualize.draw_net(config,winner, True)
+        except Exception as e:
+            warnings.warn("Couldn't draw the winning network: %s" % e)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evolve ChangeUp players with NEAT")
+    parser.add_argument('--evaluation', choices=['tournament', 'reference'], default='tournament',
+                        help="play the genomes against each other, or each against a random player")
+    parser.add_argument('--visualize', action='store_true', help="draw the winning network")
+    args = parser.parse_args()
+
     local_dir = os.path.dirname(__file__)
     config_file = os.path.join(local_dir, 'config-feedforward.txt')
-    run(config_file)
-
-
-
+    run(config_file, args.evaluation, args.visualize)
 
-player1 = Player('Foo', 'random')
-player2 = Player('Bar', 'random')
-player3 = Player('Baz', 'random')
-player4 = Player('Quux', 'random')
+    player1 = Player('Foo', 'random')
+    player2 = Player('Bar', 'random')
+    player3 = Player('Baz', 'random')
+    player4 = Player('Quux', 'random')
 
-players = [player1, player2, player3, player4]
-play_a_tournament(players)
+    players = [player1, player2, player3, player4]
+    play_a_tournament(players)